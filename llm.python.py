@@ -1,9 +1,12 @@
 # ipython llm.python.py
+import functools
 import logging
+import os
 from autogen import ConversableAgent, GroupChat, GroupChatManager, Agent
 from autogen.coding import CodeExecutor, CodeBlock, CodeResult, CodeExtractor, MarkdownCodeExtractor
-from typing import List, Union, Literal
+from typing import Dict, List, Union, Literal
 from IPython import get_ipython
+from IPython.utils.capture import capture_output
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -19,7 +22,9 @@ llm_config = {
             "price": [0, 0],  # Put in price per 1K tokens [prompt, response] as free!
         }
     ],
-    "cache_seed": None,  # Turns off caching, useful for testing different models
+    # Caching stays off by default, useful for testing different models: the cache key only sees "NotRequired",
+    # not the model LiteLLM was launched with. Set LLM_CACHE_SEED (e.g. 42) to replay identical LLM calls from disk.
+    "cache_seed": int(os.environ["LLM_CACHE_SEED"]) if os.environ.get("LLM_CACHE_SEED") else None,
 }
 
 # Custom Code Executor
@@ -37,72 +42,82 @@ class NotebookExecutor(CodeExecutor):
             raise RuntimeError("No active IPython instance found. Please ensure this code is run in an IPython environment.")
 
     def execute_code_blocks(self, code_blocks: List[CodeBlock]) -> CodeResult:
-        log = ""
+        log: List[str] = []  # Joined once at the end to avoid repeated string copies
         exit_code = 0  # Initialize exit code
         for code_block in code_blocks:
-            result = self._ipython.run_cell("%%capture --no-display cap\n" + code_block.code)
-            log += self._ipython.ev("cap.stdout")
-            log += self._ipython.ev("cap.stderr")
-            if result.result is not None:
-                log += str(result.result)
+            # Capture output in-process instead of going through the %%capture magic
+            with capture_output(display=False) as cap:
+                result = self._ipython.run_cell(code_block.code)
+            log.append(cap.stdout)  # Includes the displayhook's "Out[n]: ..." line, so result.result is not appended
+            log.append(cap.stderr)
             exit_code = 0 if result.success else 1
             if result.error_before_exec is not None:
-                log += f"\n{result.error_before_exec}"
+                log.append(f"\n{result.error_before_exec}")
                 exit_code = 1
             if result.error_in_exec is not None:
-                log += f"\n{result.error_in_exec}"
+                log.append(f"\n{result.error_in_exec}")
                 exit_code = 1
             if exit_code != 0:
                 break
-        return CodeResult(exit_code=exit_code, output=log)
+        return CodeResult(exit_code=exit_code, output="".join(log))
 
-# Generic Manager Agent
-manager_agent = ConversableAgent(
-    name="manager_agent",
-    system_message="""You are the Manager Agent. Your task is to identify tasks and set code requirements.
+# Generic Manager Agent prompt
+MANAGER_SYSTEM_MESSAGE = """You are the Manager Agent. Your task is to identify tasks and set code requirements.
     Instructions:
     - Begin your response with "Manager Agent says:".
     - Identify the task and delegate it to the Coder or Runner as needed.
     - If you need user input, use the code word "TERMINATE" to pause the chat and ask for input.
-    """,
-    llm_config=llm_config,
-    is_termination_msg=lambda msg: "TERMINATE" in msg["content"],  # Added termination message check
-    human_input_mode="TERMINATE",  # Request human input when termination conditions are met
-)
-
-# Generic Coder Agent
-coder_agent = ConversableAgent(
-    name="coder_agent",
-    system_message="""You are a helpful AI assistant.\n"
+    """
+
+# Generic Coder Agent prompt
+CODER_SYSTEM_MESSAGE = """You are a helpful AI assistant.\n"
     "You use your coding skill to solve problems.\n"
     "You have access to a IPython kernel to execute Python code.\n"
     "You can suggest Python code in Markdown blocks, each block is a cell.\n"
     "The code blocks will be executed in the IPython kernel in the order you suggest them.\n"
     "All necessary libraries have already been installed. Provide runner agent with code.\n"
-    """,
-    llm_config=llm_config,
-    is_termination_msg=lambda msg: "TERMINATE" in msg["content"],  # Added termination message check
-    human_input_mode="TERMINATE",  # Request human input when termination conditions are met
-)
-
-# Generic Runner Agent
-runner_agent = ConversableAgent(
-    name="runner_agent",
-    system_message="""You are the Runner Agent. Your task is to execute the Python code provided by the Coder.
+    """
+
+# Generic Runner Agent prompt
+RUNNER_SYSTEM_MESSAGE = """You are the Runner Agent. Your task is to execute the Python code provided by the Coder.
     Instructions:
     - Begin your response with "Runner Agent says:".
     - Execute the provided code and return the results.
-    """,
-    llm_config=llm_config,
-    is_termination_msg=lambda msg: "TERMINATE" in msg["content"],  # Added termination message check
-    human_input_mode="TERMINATE",  # Request human input when termination conditions are met
-    code_execution_config={"executor": NotebookExecutor()}
-)
+    """
+
+# Agent specs in speaking order: (name, system message, whether the agent executes code)
+AGENT_SPECS = [
+    ("manager_agent", MANAGER_SYSTEM_MESSAGE, False),
+    ("coder_agent", CODER_SYSTEM_MESSAGE, False),
+    ("runner_agent", RUNNER_SYSTEM_MESSAGE, True),
+]
 
 # Group Chat Configuration
+class ProgressGroupChat(GroupChat):
+    """GroupChat that can tell when the agents are going round in circles."""
+
+    def __post_init__(self):
+        super().__post_init__()
+        # Precomputed speaker transitions: each agent hands over to the next one in self.agents
+        self.next_speaker: Dict[Agent, Agent] = {
+            agent: self.agents[(i + 1) % len(self.agents)]
+            for i, agent in enumerate(self.agents)
+        }
+
+    def check_progress(self, messages: List[Dict]) -> bool:
+        """Return False once the last two messages form a pair that already occurred twice before.
+
+        The chat is treated as stuck only on the third occurrence of the same consecutive pair of message contents.
+        """
+        if len(messages) < 2:
+            return True
+        contents = [str(message.get("content")) for message in messages]
+        pairs = list(zip(contents, contents[1:]))
+        return pairs[:-1].count(pairs[-1]) < 2
+
 def custom_speaker_selection_func(
     last_speaker: 'Agent', 
-    groupchat: GroupChat
+    groupchat: ProgressGroupChat
 ) -> Union[ConversableAgent, Literal['auto', 'manual', 'random', 'round_robin'], None]:
     """Define a customized speaker selection function.
     A recommended way is to define a transition for each speaker in the groupchat.
@@ -110,7 +125,7 @@ def custom_speaker_selection_func(
     Parameters:
         - last_speaker: Agent
             The last speaker in the group chat.
-        - groupchat: GroupChat
+        - groupchat: ProgressGroupChat
             The GroupChat object
     Return:
         Return one of the following:
@@ -118,33 +133,49 @@ def custom_speaker_selection_func(
         2. a string from ['auto', 'manual', 'random', 'round_robin'] to select a default method to use.
         3. None, which indicates the chat should be terminated.
     """
-    priority_order = [
-        manager_agent,  
-        coder_agent, 
-        runner_agent
+    if not groupchat.check_progress(groupchat.messages):
+        logger.info("No progress in the group chat, ending it early.")
+        return None
+    speaker = groupchat.next_speaker.get(last_speaker)
+    if speaker is not None and speaker.code_executor is not None and groupchat.messages:
+        # Skip a code-executing agent when there is nothing to run, instead of spending an LLM call on its turn
+        if not speaker.code_executor.code_extractor.extract_code_blocks(groupchat.messages[-1]["content"]):
+            return groupchat.next_speaker.get(speaker)
+    return speaker
+
+@functools.lru_cache(maxsize=1)
+def _build_chat() -> GroupChatManager:
+    """Build the agents, group chat and manager on first use and reuse them afterwards."""
+    executor = NotebookExecutor()
+    agents = [
+        ConversableAgent(
+            name=name,
+            system_message=system_message,
+            llm_config=llm_config,
+            is_termination_msg=lambda msg: "TERMINATE" in msg["content"],  # Added termination message check
+            human_input_mode="TERMINATE",  # Request human input when termination conditions are met
+            code_execution_config={"executor": executor} if executes_code else False,
+        )
+        for name, system_message, executes_code in AGENT_SPECS
     ]
-    
-    if last_speaker in priority_order:
-        next_index = (priority_order.index(last_speaker) + 1) % len(priority_order)
-        return priority_order[next_index]
-    return None
-
-groupchat = GroupChat(
-    agents=[manager_agent, coder_agent, runner_agent],  # Removed user agent from the group chat
-    messages=[],
-    max_round=50,
-    speaker_selection_method=custom_speaker_selection_func
-)
-
-# Manager to handle the group chat
-manager = GroupChatManager(groupchat=groupchat, llm_config=llm_config)
+
+    groupchat = ProgressGroupChat(
+        agents=agents,  # Removed user agent from the group chat; they speak in AGENT_SPECS order
+        messages=[],
+        max_round=16,  # Upper bound only; loops are cut short by check_progress
+        speaker_selection_method=custom_speaker_selection_func
+    )
+
+    # Manager to handle the group chat
+    return GroupChatManager(groupchat=groupchat, llm_config=llm_config)
 
 def main():
     logger.info("Starting the autogen app...")
-    
+    manager = _build_chat()
+
     # Initiate the group chat
     manager.initiate_chat(
-        recipient=manager_agent,  # Start the chat with the manager agent
+        recipient=manager.groupchat.agent_by_name("manager_agent"),  # Start the chat with the manager agent
         message="""
         Let's begin the workflow. The Manager will identify tasks, the Coder will write the necessary iPython code, and the Runner will execute that code.
         If at any point you need to ask the user for input, use the code word "TERMINATE" all caps to pause the chat.